@@ -1,8 +1,9 @@
 import os, uvicorn
+import html
 import secrets
 import urllib.parse
 
-from fastapi import FastAPI, Response
+from fastapi import FastAPI
 from fastapi.responses import HTMLResponse
 
 app = FastAPI()
@@ -17,37 +18,24 @@ SCOPES = [
     "moderator:read:moderators",
     "moderator:read:chatters",
 ]
+_SCOPE_STR = "+".join(SCOPES)
 
-@app.get("/auth", response_class=HTMLResponse)
-async def auth(response: Response):
-    # 1) generate & store state
-    state = secrets.token_urlsafe(16)
-    response.set_cookie(
-        key="oauth_state",
-        value=state,
-        httponly=True,
-        secure=True,
-        samesite="lax",
-    )
-
-    # 2) build the auth URL
-    scope_str = "+".join(SCOPES)
-    params = {
+# everything but `state` is fixed, so build the URL prefix and page once
+_AUTH_URL_PREFIX = "https://id.twitch.tv/oauth2/authorize?" + urllib.parse.urlencode(
+    {
         "client_id":     CLIENT_ID,
         "redirect_uri":  REDIRECT_URI,
         "response_type": "code",
-        "scope":         scope_str,
-        "state":         state,
-    }
-    query = urllib.parse.urlencode(params, safe=":+")  # keep colons and pluses
-    auth_url = f"https://id.twitch.tv/oauth2/authorize?{query}"
+        "scope":         _SCOPE_STR,
+    },
+    safe=":+",  # keep colons and pluses
+) + "&state="
 
-    # 3) serve a simple page
-    html = f"""
+_AUTH_HTML_TEMPLATE = """
     <html>
       <head><title>Log in with Twitch</title></head>
       <body style="font-family:Arial,sans-serif; text-align:center; padding-top:50px;">
-        <a href="{auth_url}"
+        <a href="{url}"
            style="display:inline-block; padding:12px 24px; background-color:#6441a5; color:white; 
                   text-decoration:none; border-radius:4px; font-size:16px;">
           Log in with Twitch
@@ -55,11 +43,28 @@ async def auth(response: Response):
       </body>
     </html>
     """
-    return HTMLResponse(html)
+
+@app.get("/auth", response_class=HTMLResponse)
+async def auth():
+    # 1) generate state and serve a simple page pointing at the auth URL
+    state = secrets.token_urlsafe(16)
+    response = HTMLResponse(_AUTH_HTML_TEMPLATE.format(url=html.escape(_AUTH_URL_PREFIX + state)))
+
+    # 2) store state on the response we return (FastAPI drops cookies set on an
+    #    injected Response when the endpoint returns its own)
+    response.set_cookie(
+        key="oauth_state",
+        value=state,
+        httponly=True,
+        secure=True,
+        samesite="lax",
+    )
+    return response
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",      # or "your_module_name:app"
         host="0.0.0.0",
         port=8070,
-        reload=True      # omit in production
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="auto",      # uvloop when installed, else stdlib asyncio
     )
\ No newline at end of file
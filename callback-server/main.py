@@ -1,12 +1,16 @@
 import os
-import json
+import html
 import secrets
+import tempfile
 import urllib.parse
 import logging
+import asyncio
 import uvicorn
 
+import aiofiles
 import httpx
-from fastapi import FastAPI, Request, Response, HTTPException
+import orjson
+from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import HTMLResponse
 
 # ——— CONFIG ————————————————————————————————————————————————————
@@ -20,38 +24,29 @@ SCOPES        = [
     "moderator:read:moderators",
     "moderator:read:chatters",
 ]
+_SCOPE_STR    = " ".join(SCOPES)
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
 
 # ——— STEP 1: /auth — generate & store `state`, build Twitch URL ————————
-@app.get("/auth", response_class=HTMLResponse)
-async def auth(response: Response):
-    state = secrets.token_urlsafe(16)
-    response.set_cookie(
-        key="oauth_state",
-        value=state,
-        httponly=True,
-        secure=True,
-        samesite="lax",
-    )
-
-    params = {
+# everything but `state` is fixed, so build the URL prefix and page once
+_AUTH_URL_PREFIX = "https://id.twitch.tv/oauth2/authorize?" + urllib.parse.urlencode(
+    {
         "client_id":     CLIENT_ID,
         "redirect_uri":  REDIRECT_URI,
         "response_type": "code",
-        "scope":         " ".join(SCOPES),
-        "state":         state,
-    }
-    # allow spaces and colons in scope
-    query   = urllib.parse.urlencode(params, safe=":+ ")
-    auth_url = f"https://id.twitch.tv/oauth2/authorize?{query}"
+        "scope":         _SCOPE_STR,
+    },
+    safe=":+ ",  # allow spaces and colons in scope
+) + "&state="
 
-    return f"""
+_AUTH_HTML_TEMPLATE = """
     <html>
       <body style="text-align:center; font-family:sans-serif; padding-top:50px;">
-        <a href="{auth_url}"
+        <a href="{url}"
            style="background:#6441a5;color:#fff;padding:12px 24px;
                   text-decoration:none;border-radius:4px;font-size:16px;">
           Log in with Twitch
@@ -67,7 +62,56 @@ async def auth(response: Response):
     """
 
 
+@app.get("/auth", response_class=HTMLResponse)
+async def auth():
+    state = secrets.token_urlsafe(16)
+    # set the cookie on the response we return; FastAPI drops cookies set on an
+    # injected Response when the endpoint returns its own
+    response = HTMLResponse(_AUTH_HTML_TEMPLATE.format(url=html.escape(_AUTH_URL_PREFIX + state)))
+    response.set_cookie(
+        key="oauth_state",
+        value=state,
+        httponly=True,
+        secure=True,
+        samesite="lax",
+    )
+    return response
+
+
 # ——— STEP 2: /callback — verify `state`, swap code for tokens, fetch user, save —————
+async def _write_token_file(filename: str, data: bytes) -> None:
+    """
+    Atomically replace `filename` with `data`: write a uniquely named temp file
+    in the same directory, fsync it, then rename it over the target. Concurrent
+    writers never share a temp file, and a crash leaves either the old or the
+    new record, never a truncated one.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                               prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        async with aiofiles.open(fd, "wb") as f:
+            await f.write(data)
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+_SUCCESS_HTML = """
+      <html>
+        <body style="text-align:center; font-family:sans-serif; padding-top:50px;">
+          <h1>✅ Authorized as {name}</h1>
+          <p>You may now close this window.</p>
+        </body>
+      </html>
+    """
+
+
 @app.get("/callback", response_class=HTMLResponse)
 async def callback(request: Request):
     # 1) extract & verify state
@@ -78,36 +122,36 @@ async def callback(request: Request):
     if not code or not returned_state or returned_state != stored_state:
         raise HTTPException(400, "Invalid OAuth callback (missing code or bad state)")
 
-    logging.info("State verified, exchanging code for tokens…")
+    logger.info("State verified, exchanging code for tokens…")
 
     # 2) exchange code for tokens
-    async with httpx.AsyncClient() as client:
-        token_resp = await client.post(
-            "https://id.twitch.tv/oauth2/token",
-            data={
-                "client_id":     CLIENT_ID,
-                "client_secret": CLIENT_SECRET,
-                "code":          code,
-                "grant_type":    "authorization_code",
-                "redirect_uri":  REDIRECT_URI,
-            },
-        )
-        if token_resp.status_code != 200:
-            body = await token_resp.text()
-            logging.error(f"Twitch token error {token_resp.status_code}: {body}")
-            raise HTTPException(token_resp.status_code, f"Twitch token error: {body}")
-        tokens = token_resp.json()
-
-        # 3) fetch authenticated user info
-        user_resp = await client.get(
-            "https://api.twitch.tv/helix/users",
-            headers={
-                "Client-ID":     CLIENT_ID,
-                "Authorization": f"Bearer {tokens['access_token']}"
-            }
-        )
-        user_resp.raise_for_status()
-        user_data = user_resp.json()["data"][0]
+    client = request.app.state.http
+    token_resp = await client.post(
+        "https://id.twitch.tv/oauth2/token",
+        data={
+            "client_id":     CLIENT_ID,
+            "client_secret": CLIENT_SECRET,
+            "code":          code,
+            "grant_type":    "authorization_code",
+            "redirect_uri":  REDIRECT_URI,
+        },
+    )
+    if token_resp.status_code != 200:
+        body = token_resp.text
+        logger.error("Twitch token error %s: %s", token_resp.status_code, body)
+        raise HTTPException(token_resp.status_code, f"Twitch token error: {body}")
+    tokens = orjson.loads(token_resp.content)
+
+    # 3) fetch authenticated user info
+    user_resp = await client.get(
+        "https://api.twitch.tv/helix/users",
+        headers={
+            "Client-ID":     CLIENT_ID,
+            "Authorization": f"Bearer {tokens['access_token']}"
+        }
+    )
+    user_resp.raise_for_status()
+    user_data = orjson.loads(user_resp.content)["data"][0]
 
     # 4) assemble output
     out = {
@@ -120,35 +164,43 @@ async def callback(request: Request):
         "tokens": tokens
     }
 
-    # 5) write to tokens_<login>.json
+    # 5) write to tokens_<login>.json (temp file + fsync + rename, so it is never half-written)
     filename = f"tokens_{user_data['id']}.json"
-    with open(filename, "w") as f:
-        json.dump(out, f, indent=2)
-    logging.info(f"Saved tokens for {user_data['login']} → {filename}")
+    await _write_token_file(filename, orjson.dumps(out, option=orjson.OPT_INDENT_2))
+    logger.info("Saved tokens for %s → %s", user_data["login"], filename)
 
     # 6) confirm to user
-    return f"""
-      <html>
-        <body style="text-align:center; font-family:sans-serif; padding-top:50px;">
-          <h1>✅ Authorized as {user_data['display_name']}</h1>
-          <p>You may now close this window.</p>
-        </body>
-      </html>
-    """
+    return HTMLResponse(_SUCCESS_HTML.format(name=html.escape(user_data["display_name"])))
+
+
+# ——— Shared HTTP client: one connection pool for all Twitch calls ———————————
+@app.on_event("startup")
+async def open_http_client():
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    )
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
 
 
 # ——— Optional: load existing tokens on startup —————————————————————————
 @app.on_event("startup")
 def load_tokens():
     # scans cwd for any tokens_*.json and logs them
-    for fname in os.listdir("."):
-        if fname.startswith("tokens_") and fname.endswith(".json"):
-            logging.info(f"Found existing token file: {fname}")
+    with os.scandir(".") as entries:
+        for entry in entries:
+            if entry.name.startswith("tokens_") and entry.name.endswith(".json"):
+                logger.info("Found existing token file: %s", entry.name)
 
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",      # or "your_module_name:app"
         host="0.0.0.0",
         port=8070,
-        reload=True      # omit in production
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="auto",      # uvloop when installed, else stdlib asyncio
     )
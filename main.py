@@ -1,33 +1,44 @@
 import os
-import json
-import glob
+import html
+import hmac
+import base64
+import hashlib
 import secrets
+import tempfile
+import time
 import urllib.parse
 import logging
 import asyncio
+import threading
 import uvicorn
 from contextlib import asynccontextmanager
 
+import aiofiles
 import httpx
-from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+import orjson
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse
 
 from twitchAPI.twitch import Twitch
 from twitchAPI.chat import Chat, ChatEvent, ChatMessage, ChatCommand
+from twitchAPI.eventsub.websocket import EventSubWebsocket
+from twitchAPI.object.eventsub import ChannelCheerEvent
 from twitchAPI.type import AuthScope
 from dotenv import load_dotenv
 
 # ——— CONFIG ——————————————————————————————————————————————
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
 
 CLIENT_ID       = os.getenv("TWITCH_CLIENT_ID")
 CLIENT_SECRET   = os.getenv("TWITCH_SECRET")
 CALLBACK_URL    = os.getenv("CALLBACK_URL")  # e.g. https://twitch.cmchale.com/callback
-WEBHOOK_SECRET  = os.getenv("WEBHOOK_SECRET")
 BIT_SPIN_AMOUNT = int(os.getenv("BIT_SPIN_AMOUNT", "555"))
 USER_NAME       = os.getenv("USER_NAME")
 
+TWITCH_CONNECT_TIMEOUT = 30  # seconds to wait for a twitchAPI socket to come up
+
 # Scopes required for both chat listening and EventSub
 ALL_SCOPES = [
     AuthScope.CHAT_READ,
@@ -37,139 +48,285 @@ ALL_SCOPES = [
     AuthScope.MODERATOR_READ_CHATTERS,
 ]
 
+_SCOPE_STR = " ".join(s.value for s in ALL_SCOPES)
+
 TOKENS_GLOB = f"tokens_{USER_NAME}.json"
 
 # ——— STATE ——————————————————————————————————————————————
-clients    = set()            # active WebSocket connections
-spin_queue = asyncio.Queue()  # queued spin requests
+clients          = set()            # active WebSocket connections
+spin_event       = asyncio.Event()  # set when a spin is pending; extra triggers coalesce
+chat_clients     = []               # running twitchAPI Chat clients, stopped on shutdown
+eventsub_clients = []               # running EventSubWebsocket clients, stopped on shutdown
+
+# Prebuilt ASGI message for the spin broadcast, shared by every client send.
+# Kept as a text frame so existing overlays that compare against "spin" still work.
+_SPIN_MESSAGE = {"type": "websocket.send", "text": "spin"}
+
+async def _start_in_daemon_thread(client, running: list) -> None:
+    """
+    Run a twitchAPI client's blocking start() without stalling the event loop,
+    and record it in `running` (one of the *_clients lists) once it is up.
+    start() busy-waits until its socket is up and never returns if the connect
+    fails, so it runs in a daemon thread (the socket thread it spawns inherits
+    that) and we give up waiting after TWITCH_CONNECT_TIMEOUT. A client that
+    still comes up after that is recorded anyway, so shutdown stops it.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.create_future()
+
+    def settle(error: BaseException | None) -> None:
+        if error is None:
+            running.append(client)
+        if started.done():  # we already gave up waiting
+            if error is None:
+                logger.warning("%s started after the connect timeout; it will be stopped on shutdown",
+                               type(client).__name__)
+            return
+        if error is None:
+            started.set_result(None)
+        else:
+            started.set_exception(error)
+
+    def run() -> None:
+        error = None
+        try:
+            client.start()
+        except BaseException as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(settle, error)
+        except RuntimeError:  # loop already closed, app has shut down
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    await asyncio.wait_for(started, TWITCH_CONNECT_TIMEOUT)
 
 def _find_token_file() -> str | None:
-    files = glob.glob(TOKENS_GLOB)
-    return files[0] if files else None
+    # TOKENS_GLOB is a literal filename, no need to glob for it
+    return TOKENS_GLOB if os.path.exists(TOKENS_GLOB) else None
+
+async def _write_token_file(filename: str, data: bytes) -> None:
+    """
+    Atomically replace `filename` with `data`: write a uniquely named temp file
+    in the same directory, fsync it, then rename it over the target. Concurrent
+    writers never share a temp file, and a crash leaves either the old or the
+    new record, never a truncated one.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                               prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        async with aiofiles.open(fd, "wb") as f:
+            await f.write(data)
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
 
-async def _setup_twitch(access_token: str, refresh_token: str, broadcaster_id: str, broadcaster_login: str) -> None:
+async def _setup_twitch(access_token: str, refresh_token: str, broadcaster_id: str, broadcaster_login: str) -> Twitch:
     """
-    Authenticate once with full scopes, subscribe to bits events, and start chat listener.
+    Authenticate once with full scopes and subscribe to bits events.
+    Returns the authenticated client so the chat listener can reuse it.
     """
     twitch = await Twitch(CLIENT_ID, CLIENT_SECRET)
     await twitch.set_user_authentication(access_token, ALL_SCOPES, refresh_token)
-    logging.info(f"Twitch authenticated for user {broadcaster_login} (ID {broadcaster_id})")
+    logger.info("Twitch authenticated for user %s (ID %s)", broadcaster_login, broadcaster_id)
+
+    loop = asyncio.get_running_loop()
 
-    # Subscribe to bits via EventSub
+    async def on_cheer(data: ChannelCheerEvent) -> None:
+        bits = data.event.bits
+        logger.info("%s cheered %s bits", data.event.user_name, bits)
+        if bits == BIT_SPIN_AMOUNT:
+            # EventSub callbacks run on twitchAPI's socket loop; hand off to ours
+            loop.call_soon_threadsafe(spin_event.set)
+
+    # Subscribe to bits via EventSub over a persistent outbound WebSocket
     try:
-        await twitch.create_eventsub_subscription(
-            subscription_type="channel.cheer",
-            version="1",
-            condition={"broadcaster_user_id": broadcaster_id},
-            transport={
-                "method":   "webhook",
-                "callback": CALLBACK_URL,
-                "secret":   WEBHOOK_SECRET,
-            },
-        )
-        logging.info("Subscribed to channel.cheer EventSub")
+        eventsub = EventSubWebsocket(twitch)
+        await _start_in_daemon_thread(eventsub, eventsub_clients)
+        await eventsub.listen_channel_cheer(broadcaster_id, on_cheer)
+        logger.info("Subscribed to channel.cheer EventSub")
     except Exception as e:
-        logging.error(f"EventSub subscription failed: {e}")
+        logger.error("EventSub subscription failed: %r", e)
 
-    # Start chat listener
-    asyncio.create_task(_start_chat_listener(access_token, refresh_token, broadcaster_login))
+    return twitch
 
-async def _start_chat_listener(access_token: str, refresh_token: str, broadcaster_login: str) -> None:
+async def _start_chat_listener(twitch: Twitch, broadcaster_login: str) -> None:
     """
     Listen for '!spin' commands from moderators in chat using the same Twitch auth client.
     """
-    twitch = await Twitch(CLIENT_ID, CLIENT_SECRET)
-    await twitch.set_user_authentication(access_token, ALL_SCOPES, refresh_token)
     chat = await Chat(twitch)
+    loop = asyncio.get_running_loop()
 
     async def on_ready(evt) -> None:
         await evt.chat.join_room(broadcaster_login)
-        logging.info(f"Chat listener joined room {broadcaster_login}")
+        logger.info("Chat listener joined room %s", broadcaster_login)
 
     async def on_spin_message(cmd: ChatCommand) -> None:
             if cmd.name == "spin" and (cmd.user.mod or cmd.user.name == cmd.room.name):
-                logging.info(f"Moderator {cmd.user.name} requested a spin via chat")
-                await spin_queue.put("spin")
+                logger.info("Moderator %s requested a spin via chat", cmd.user.name)
+                # Chat callbacks run on twitchAPI's socket loop; hand off to ours
+                loop.call_soon_threadsafe(spin_event.set)
             else:
-                logging.info(f"User {cmd.user.name} tried to spin but is not a mod")
+                logger.info("User %s tried to spin but is not a mod", cmd.user.name)
 
     chat.register_event(ChatEvent.READY, on_ready)
     chat.register_command('spin', on_spin_message)
 
-    # Start the chat client in a background thread
-    import threading
-    threading.Thread(target=chat.start, daemon=True).start()
+    try:
+        await _start_in_daemon_thread(chat, chat_clients)
+    except Exception as e:
+        logger.error("Chat listener failed to start: %r", e)
+
+async def _safe_send(ws: WebSocket, message: dict, dead: list) -> None:
+    """Send to one client, recording it in `dead` instead of raising if it has gone away."""
+    try:
+        await ws.send(message)
+    except (WebSocketDisconnect, RuntimeError, OSError):
+        dead.append(ws)
 
 async def spin_processor() -> None:
-    """Process queued spins sequentially, each taking 9 seconds."""
+    """Process pending spins sequentially, each taking 9 seconds. At most one spin is ever pending."""
     while True:
-        await spin_queue.get()
+        await spin_event.wait()
+        spin_event.clear()
         if clients:
-            logging.info("Broadcasting spin to WebSocket clients")
-            await asyncio.gather(*[ws.send_text("spin") for ws in clients])
+            logger.info("Broadcasting spin to WebSocket clients")
+            # snapshot: ws_spin may add/remove clients while we are sending
+            snapshot = tuple(clients)
+            dead = []
+            async with asyncio.TaskGroup() as tg:
+                for ws in snapshot:
+                    tg.create_task(_safe_send(ws, _SPIN_MESSAGE, dead))
+            clients.difference_update(dead)
         else:
-            logging.info("No WebSocket clients connected; skipping spin")
+            logger.info("No WebSocket clients connected; skipping spin")
         await asyncio.sleep(9)
-        spin_queue.task_done()
-        logging.info("Spin completed")
+        logger.info("Spin completed")
+
+async def _stop_twitch_clients() -> None:
+    """
+    Stop every running EventSub and chat client. Both stop() calls block on
+    twitchAPI's socket loop, so they run in a worker thread; one failing does
+    not prevent the rest from being stopped.
+    """
+    for eventsub in eventsub_clients:
+        try:
+            await asyncio.to_thread(asyncio.run, eventsub.stop())
+        except Exception as e:
+            logger.error("EventSub client failed to stop: %r", e)
+    eventsub_clients.clear()
+    for chat in chat_clients:
+        try:
+            await asyncio.to_thread(chat.stop)
+        except Exception as e:
+            logger.error("Chat client failed to stop: %r", e)
+    chat_clients.clear()
 
 # ——— LIFESPAN: startup & shutdown ——————————————————————————————
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    token_file = _find_token_file()
-    if token_file:
-        data  = json.load(open(token_file))
-        creds = data["tokens"]
-        uid   = data["user"]["id"]
-        login = data["user"]["login"]
-        await _setup_twitch(creds["access_token"], creds.get("refresh_token"), uid, login)
-    asyncio.create_task(spin_processor())
-    yield
-
-app = FastAPI(lifespan=lifespan)
+    # One pooled client for all Twitch OAuth/Helix calls
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    )
+    try:
+        token_file = _find_token_file()
+        if token_file:
+            async with aiofiles.open(token_file, "rb") as f:
+                data = orjson.loads(await f.read())
+            creds = data["tokens"]
+            uid   = data["user"]["id"]
+            login = data["user"]["login"]
+            twitch = await _setup_twitch(creds["access_token"], creds.get("refresh_token"), uid, login)
+            asyncio.create_task(_start_chat_listener(twitch, login))
+        asyncio.create_task(spin_processor())
+        yield
+    finally:
+        await _stop_twitch_clients()
+        await app.state.http.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # ——— 1) /auth ——————————————————————————————————————————————
-@app.get("/auth", response_class=HTMLResponse)
-async def auth(response: Response) -> RedirectResponse:
-    state = secrets.token_urlsafe(16)
-    response.set_cookie("oauth_state", state, httponly=True, secure=True, samesite="lax")
-    params = {
+# everything but `state` is fixed, so build the URL prefix once
+_AUTH_URL_PREFIX = "https://id.twitch.tv/oauth2/authorize?" + urllib.parse.urlencode(
+    {
         "client_id":     CLIENT_ID,
         "redirect_uri":  CALLBACK_URL,
         "response_type": "code",
-        "scope":         " ".join([s.value for s in ALL_SCOPES]),
-        "state":         state,
+        "scope":         _SCOPE_STR,
         "force_verify":  "true",
-    }
-    query = urllib.parse.urlencode(params, safe=":+")
-    auth_url = f"https://id.twitch.tv/oauth2/authorize?{query}"
-    return RedirectResponse(auth_url)
+    },
+    safe=":+",
+) + "&state="
+
+# OAuth `state` is a nonce and issue time plus their HMAC, so /callback can
+# verify it from the query string alone instead of round-tripping a cookie
+_STATE_KEY     = secrets.token_bytes(32)
+_STATE_MAX_AGE = 600  # seconds a login link stays valid
+
+def _state_mac(payload: bytes) -> bytes:
+    return hmac.new(_STATE_KEY, payload, hashlib.sha256).digest()[:16]
+
+def _make_state() -> str:
+    payload = secrets.token_bytes(16) + int(time.time()).to_bytes(8, "big")
+    return base64.urlsafe_b64encode(payload + _state_mac(payload)).decode().rstrip("=")
+
+def _verify_state(state: str) -> bool:
+    try:
+        raw = base64.urlsafe_b64decode(state + "=" * (-len(state) % 4))
+    except ValueError:
+        return False
+    if len(raw) != 40:
+        return False
+    payload, mac = raw[:24], raw[24:]
+    if not hmac.compare_digest(mac, _state_mac(payload)):
+        return False
+    issued_at = int.from_bytes(payload[16:], "big")
+    return 0 <= time.time() - issued_at <= _STATE_MAX_AGE
+
+@app.get("/auth", response_class=HTMLResponse)
+async def auth() -> RedirectResponse:
+    return RedirectResponse(_AUTH_URL_PREFIX + _make_state())
 
 # ——— 2) /callback ——————————————————————————————————————————————
+_SUCCESS_HTML = """
+<html><body style="text-align:center; font-family:sans-serif; padding-top:50px;">
+  <h1>✅ Authorized as {name}</h1>
+  <p>Tokens saved to <code>{fname}</code>. You may close this window.</p>
+</body></html>
+"""
+
 @app.get("/callback", response_class=HTMLResponse)
 async def callback(request: Request) -> HTMLResponse:
     code           = request.query_params.get("code")
     returned_state = request.query_params.get("state")
-    stored_state   = request.cookies.get("oauth_state")
-    if not code or returned_state != stored_state:
+    if not code or not returned_state or not _verify_state(returned_state):
         raise HTTPException(400, "Invalid OAuth callback (bad state or missing code)")
 
-    async with httpx.AsyncClient() as client:
-        tr = await client.post("https://id.twitch.tv/oauth2/token", data={
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "code": code,
-            "grant_type": "authorization_code",
-            "redirect_uri": CALLBACK_URL,
-        })
-        tr.raise_for_status()
-        tokens = tr.json()
-        ur = await client.get("https://api.twitch.tv/helix/users", headers={
-            "Client-ID": CLIENT_ID,
-            "Authorization": f"Bearer {tokens['access_token']}"
-        })
-        ur.raise_for_status()
-        user = ur.json()["data"][0]
+    client = request.app.state.http
+    tr = await client.post("https://id.twitch.tv/oauth2/token", data={
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "code": code,
+        "grant_type": "authorization_code",
+        "redirect_uri": CALLBACK_URL,
+    })
+    tr.raise_for_status()
+    tokens = orjson.loads(tr.content)
+    ur = await client.get("https://api.twitch.tv/helix/users", headers={
+        "Client-ID": CLIENT_ID,
+        "Authorization": f"Bearer {tokens['access_token']}"
+    })
+    ur.raise_for_status()
+    user = orjson.loads(ur.content)["data"][0]
 
     record = {
         "state": returned_state,
@@ -177,49 +334,32 @@ async def callback(request: Request) -> HTMLResponse:
         "tokens": tokens
     }
     filename = f"tokens_{user['login']}.json"
-    with open(filename, "w") as f:
-        json.dump(record, f, indent=2)
-    logging.info(f"Saved OAuth record to {filename}")
+    await _write_token_file(filename, orjson.dumps(record, option=orjson.OPT_INDENT_2))
+    logger.info("Saved OAuth record to %s", filename)
 
-    await _setup_twitch(tokens["access_token"], tokens.get("refresh_token"), user["id"], user["login"])
+    twitch = await _setup_twitch(tokens["access_token"], tokens.get("refresh_token"), user["id"], user["login"])
+    asyncio.create_task(_start_chat_listener(twitch, user["login"]))
 
-    return f"""
-<html><body style="text-align:center; font-family:sans-serif; padding-top:50px;">
-  <h1>✅ Authorized as {user['display_name']}</h1>
-  <p>Tokens saved to <code>{filename}</code>. You may close this window.</p>
-</body></html>
-"""
-
-# ——— 3) /eventsub ——————————————————————————————————————————————
-@app.post("/eventsub")
-async def eventsub(webhook_payload: dict) -> dict:
-    if webhook_payload.get("challenge"):
-        return JSONResponse({"challenge": webhook_payload["challenge"]})
-    stype = webhook_payload.get("subscription", {}).get("type")
-    if stype == "channel.cheer":
-        bits = webhook_payload["event"]["bits"]
-        user = webhook_payload["event"]["user_name"]
-        logging.info(f"{user} cheered {bits} bits")
-        if bits == BIT_SPIN_AMOUNT:
-            await spin_queue.put("spin")
-    return {"status": "ok"}
+    return HTMLResponse(_SUCCESS_HTML.format(name=html.escape(user["display_name"]), fname=html.escape(filename)))
 
-# ——— 4) WebSocket endpoint ——————————————————————————————————————
+# ——— 3) WebSocket endpoint ——————————————————————————————————————
 @app.websocket("/ws/spin")
 async def ws_spin(ws: WebSocket) -> None:
     await ws.accept()
     clients.add(ws)
-    logging.info("WebSocket client connected")
+    logger.info("WebSocket client connected")
     try:
-        while True:
-            msg = await ws.receive_text()
-            logging.info(f"WS recv: {msg}")
-            await ws.send_text("ack")
-    except WebSocketDisconnect:
-        logging.info("WebSocket client disconnected")
+        # Clients never send anything we act on; drain frames until they leave.
+        # Liveness is covered by uvicorn's protocol-level pings (see RUN below).
+        while (await ws.receive())["type"] != "websocket.disconnect":
+            pass
+        logger.info("WebSocket client disconnected")
     finally:
-        clients.remove(ws)
+        clients.discard(ws)  # may already be pruned by spin_processor
 
 # ——— RUN ———————————————————————————————————————————————————————
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8070, reload=True)
+    # Single worker: the chat listener, EventSub subscription, spin queue and
+    # WebSocket clients all live in this process.
+    uvicorn.run("main:app", host="0.0.0.0", port=8070, reload=True, loop="auto",  # uvloop when installed
+                ws_ping_interval=20, ws_ping_timeout=20)